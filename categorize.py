@@ -4,11 +4,35 @@ Categorize pages using LLM based on title + description.
 Replaces the auto-extracted topics with meaningful categories.
 """
 
+import argparse
+import asyncio
+import hashlib
 import json
 import os
+import random
+import time
 import db
 import httpx
 
+API_URL = "https://api.anthropic.com/v1/messages"
+BATCHES_URL = "https://api.anthropic.com/v1/messages/batches"
+BATCH_POLL_INTERVAL = 30
+MODEL = "claude-sonnet-4-20250514"
+
+# Concurrency and rate-limit defaults (Anthropic tier 1)
+MAX_CONCURRENCY = 10
+REQUESTS_PER_MINUTE = 40
+TOKENS_PER_MINUTE = 16000
+MAX_ATTEMPTS = 4
+RETRY_INITIAL_DELAY = 2  # seconds; doubled per attempt plus up to 1s jitter
+RETRY_MAX_DELAY = 30
+
+# Pages per prompt: pack up to BATCH_SIZE pages or MAX_PROMPT_TOKENS, whichever comes first
+BATCH_SIZE = 40
+MAX_PROMPT_TOKENS = 8000
+OUTPUT_TOKENS_PER_PAGE = 50
+TUNE_BATCH_SIZES = (10, 20, 40)
+
 API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
 if not API_KEY:
     # Try to read from common locations
@@ -37,71 +61,455 @@ CATEGORIES = """
 - General Science Education
 """
 
-def categorize_batch(pages: list[dict]) -> dict[int, list[str]]:
-    """Categorize multiple pages in one API call."""
-    
-    pages_text = ""
-    for i, p in enumerate(pages):
-        pages_text += f"""
+INSTRUCTIONS = f"""Categorize the educational pages listed after these instructions. For each page, assign 1-3 relevant topic categories.
+
+Choose from these categories (or suggest a better one if clearly needed):
+{CATEGORIES}
+
+Record your answer with the record_categories tool, one entry per page, using the page's numeric ID."""
+
+# Forcing this tool gives a JSON reply that matches the schema instead of free text
+CATEGORIES_TOOL = {
+    "name": "record_categories",
+    "description": "Record the topic categories assigned to each page.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "integer"},
+                        "categories": {"type": "array", "items": {"type": "string"}},
+                    },
+                    "required": ["id", "categories"],
+                },
+            },
+        },
+        "required": ["results"],
+    },
+}
+
+
+def format_page(p: dict) -> str:
+    return f"""
 Page {p['id']}:
   Title: {p['title'] or 'No title'}
   Description: {(p['description'] or 'No description')[:300]}
   Domain: {p['domain']}
 """
 
-    prompt = f"""Categorize these educational pages. For each page, assign 1-3 relevant topic categories.
 
-{pages_text}
+def build_request(pages: list[dict]) -> dict:
+    """Messages API request body for a batch of pages.
 
-Choose from these categories (or suggest a better one if clearly needed):
-{CATEGORIES}
+    The static instructions go first and are marked for prompt caching, so
+    only the page list changes between requests.
+    """
+    return {
+        "model": MODEL,
+        "max_tokens": 256 + OUTPUT_TOKENS_PER_PAGE * len(pages),
+        "tools": [CATEGORIES_TOOL],
+        "tool_choice": {"type": "tool", "name": CATEGORIES_TOOL["name"]},
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": INSTRUCTIONS, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": "".join(format_page(p) for p in pages)},
+            ],
+        }]
+    }
 
-Reply in this exact format:
-PAGE_ID: Category 1, Category 2
-PAGE_ID: Category 1
 
-Example:
-42: Physics / Light & Optics, Science Methods / Experiments
-43: Earth Science / Weather"""
+def api_headers() -> dict:
+    return {
+        "x-api-key": API_KEY,
+        "anthropic-version": "2023-06-01",
+        "content-type": "application/json",
+    }
+
+
+def parse_message(message: dict) -> dict[int, list[str]]:
+    """Extract page categories from a Messages API response body.
+
+    Malformed entries are skipped one by one rather than failing the batch,
+    and the number dropped is printed.
+    """
+    categories = {}
+    dropped = 0
+    for block in message["content"]:
+        if block.get("type") != "tool_use" or block.get("name") != CATEGORIES_TOOL["name"]:
+            continue
+        results = block["input"].get("results")
+        if not isinstance(results, list):
+            print(f"  Dropped tool call: results is {type(results).__name__}, not a list")
+            continue
+        for entry in results:
+            cats = entry.get("categories") if isinstance(entry, dict) else None
+            if not isinstance(cats, list):
+                dropped += 1
+                continue
+            try:
+                page_id = int(entry["id"])
+            except (KeyError, TypeError, ValueError):
+                dropped += 1
+                continue
+            categories[page_id] = [str(c).strip() for c in cats]
+    if dropped:
+        print(f"  Dropped {dropped} malformed result entries")
+    return categories
+
+
+def page_hash(p: dict) -> str:
+    """Cache key for a page's prompt input; the page ID is deliberately left out."""
+    key = "\x00".join([p['title'] or '', p['description'] or '', p['domain'] or ''])
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def split_cached(pages: list[dict]) -> tuple[dict[int, list[str]], list[dict]]:
+    """Return categories for pages seen before, and the pages still to categorize."""
+    cached = db.get_cached_categories({page_hash(p) for p in pages})
+    categories, uncached = {}, []
+    for p in pages:
+        response = cached.get(page_hash(p))
+        if response is None:
+            uncached.append(p)
+        else:
+            categories[p['id']] = json.loads(response)
+    return categories, uncached
+
+
+def save_to_cache(pages: list[dict], categories: dict[int, list[str]]):
+    db.cache_categories([
+        (page_hash(p), json.dumps(categories[p['id']]))
+        for p in pages if p['id'] in categories
+    ])
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token)."""
+    return len(text) // 4
+
+
+def static_prompt_tokens() -> int:
+    """Estimated tokens sent with every request: instructions plus tool schema."""
+    return estimate_tokens(INSTRUCTIONS) + estimate_tokens(json.dumps(CATEGORIES_TOOL))
+
+
+def make_batches(pages: list[dict], batch_size: int, max_prompt_tokens: int) -> list[list[dict]]:
+    """Pack pages into prompts of at most batch_size pages and ~max_prompt_tokens tokens."""
+    overhead = static_prompt_tokens()
+    batches = []
+    batch, batch_tokens = [], overhead
+    for p in pages:
+        tokens = estimate_tokens(format_page(p))
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_prompt_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], overhead
+        batch.append(p)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class RateLimiter:
+    """Token bucket enforcing both requests/minute and tokens/minute."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available_requests = min(
+            self.requests_per_minute,
+            self.available_requests + elapsed * self.requests_per_minute / 60,
+        )
+        self.available_tokens = min(
+            self.tokens_per_minute,
+            self.available_tokens + elapsed * self.tokens_per_minute / 60,
+        )
+
+    async def acquire(self, tokens: int):
+        """Wait until one request and `tokens` tokens fit in the budget."""
+        tokens = min(tokens, self.tokens_per_minute)  # oversized requests wait for a full bucket
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.available_requests) * 60 / self.requests_per_minute,
+                    (tokens - self.available_tokens) * 60 / self.tokens_per_minute,
+                )
+                await asyncio.sleep(wait)
+
+
+_client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=60)
+    return _client
+
+
+def should_retry(response: httpx.Response) -> bool:
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def retry_delay(response: httpx.Response | None, attempt: int) -> float:
+    """Seconds to wait before retrying: the retry-after header, else exponential backoff
+    with jitter. Either is capped at RETRY_MAX_DELAY."""
+    if response is not None:
+        try:
+            return min(RETRY_MAX_DELAY, float(response.headers["retry-after"]))
+        except (KeyError, ValueError):
+            pass
+    return min(RETRY_MAX_DELAY, RETRY_INITIAL_DELAY * 2 ** attempt + random.uniform(0, 1))
+
+
+async def categorize_batch(pages: list[dict], limiter: RateLimiter | None = None) -> dict[int, list[str]]:
+    """Categorize multiple pages in one API call.
+
+    Timeouts, connection errors, 429 and 5xx responses are retried up to
+    MAX_ATTEMPTS times in total.
+    """
+    payload = build_request(pages)
+    prompt_tokens = static_prompt_tokens() + estimate_tokens(payload["messages"][0]["content"][1]["text"])
+
+    for attempt in range(MAX_ATTEMPTS):
+        last_attempt = attempt == MAX_ATTEMPTS - 1
+        if limiter:
+            await limiter.acquire(prompt_tokens + payload["max_tokens"])
+        try:
+            response = await get_client().post(API_URL, headers=api_headers(), json=payload)
+        except httpx.TransportError as e:
+            if last_attempt:
+                print(f"API request failed: {e!r}")
+                return {}
+            delay = retry_delay(None, attempt)
+            print(f"API request failed ({e!r}), retrying in {delay:.0f}s...")
+            await asyncio.sleep(delay)
+            continue
+        if not should_retry(response) or last_attempt:
+            break
+        delay = retry_delay(response, attempt)
+        print(f"API busy ({response.status_code}), retrying in {delay:.0f}s...")
+        await asyncio.sleep(delay)
 
-    response = httpx.post(
-        "https://api.anthropic.com/v1/messages",
-        headers={
-            "x-api-key": API_KEY,
-            "anthropic-version": "2023-06-01",
-            "content-type": "application/json",
-        },
-        json={
-            "model": "claude-sonnet-4-20250514",
-            "max_tokens": 1024,
-            "messages": [{"role": "user", "content": prompt}]
-        },
-        timeout=60
-    )
-    
     if response.status_code != 200:
         print(f"API error: {response.status_code} {response.text}")
         return {}
-    
-    result = response.json()
-    text = result["content"][0]["text"]
-    
-    # Parse response
+
+    return parse_message(response.json())
+
+
+async def run_all(
+    batches: list[list[dict]],
+    limiter: RateLimiter,
+    max_concurrency: int = MAX_CONCURRENCY,
+) -> dict[int, list[str]]:
+    """Categorize all batches concurrently within the rate limits."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+    done = 0
+
+    async def bounded(batch):
+        nonlocal done
+        async with semaphore:
+            cats = await categorize_batch(batch, limiter)
+        done += 1
+        print(f"Finished batch {done}/{len(batches)}")
+        for page_id, page_cats in cats.items():
+            print(f"  Page {page_id}: {', '.join(page_cats)}")
+        return cats
+
+    results = await asyncio.gather(*[bounded(b) for b in batches])
+
+    all_categories = {}
+    for cats in results:
+        all_categories.update(cats)
+    return all_categories
+
+
+async def tune_batch_size(
+    pages: list[dict], max_prompt_tokens: int, limiter: RateLimiter
+) -> tuple[int, dict[int, list[str]], list[dict]]:
+    """Time one batch at each of TUNE_BATCH_SIZES and pick the most pages/second.
+
+    Larger prompts save requests but get slower per call, so the best size
+    depends on the model's current latency. Trial results are kept; returns
+    (best size, trial categories, pages not yet categorized).
+    """
     categories = {}
-    for line in text.strip().split('\n'):
-        if ':' in line:
-            parts = line.split(':', 1)
-            try:
-                page_id = int(parts[0].strip())
-                cats = [c.strip() for c in parts[1].split(',')]
-                categories[page_id] = cats
-            except (ValueError, IndexError):
+    best_size, best_rate = TUNE_BATCH_SIZES[0], 0.0
+    for size in TUNE_BATCH_SIZES:
+        if not pages:
+            break
+        batch = make_batches(pages, size, max_prompt_tokens)[0]
+        pages = pages[len(batch):]
+        start = time.monotonic()
+        cats = await categorize_batch(batch, limiter)
+        rate = len(cats) / (time.monotonic() - start)
+        print(f"  Batch size {len(batch)}: {rate:.1f} pages/s")
+        categories.update(cats)
+        if rate > best_rate:
+            best_size, best_rate = len(batch), rate
+    print(f"Using batch size {best_size}")
+    return best_size, categories, pages
+
+
+async def run_live(
+    pages: list[dict],
+    batch_size: int,
+    max_prompt_tokens: int,
+    tune: bool,
+    max_concurrency: int = MAX_CONCURRENCY,
+    requests_per_minute: int = REQUESTS_PER_MINUTE,
+    tokens_per_minute: int = TOKENS_PER_MINUTE,
+) -> dict[int, list[str]]:
+    """Categorize pages with concurrent Messages API calls."""
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    all_categories = {}
+    try:
+        if tune:
+            print("Tuning batch size...")
+            batch_size, all_categories, pages = await tune_batch_size(pages, max_prompt_tokens, limiter)
+        batches = make_batches(pages, batch_size, max_prompt_tokens)
+        print(f"Processing {len(batches)} batches (up to {max_concurrency} concurrent)...")
+        all_categories.update(await run_all(batches, limiter, max_concurrency))
+    finally:
+        await get_client().aclose()
+    return all_categories
+
+
+def submit_message_batch(client: httpx.Client, batches: list[list[dict]]) -> str:
+    """Submit one Message Batches request per page batch; returns the batch ID."""
+    requests = [
+        {"custom_id": f"batch-{i}", "params": build_request(batch)}
+        for i, batch in enumerate(batches)
+    ]
+    response = client.post(BATCHES_URL, headers=api_headers(), json={"requests": requests})
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def wait_for_message_batch(client: httpx.Client, batch_id: str) -> dict:
+    """Poll a message batch until processing has ended."""
+    while True:
+        response = client.get(f"{BATCHES_URL}/{batch_id}", headers=api_headers())
+        response.raise_for_status()
+        batch = response.json()
+        if batch["processing_status"] == "ended":
+            return batch
+        counts = batch["request_counts"]
+        print(f"  {counts['processing']} processing, {counts['succeeded']} succeeded, "
+              f"{counts['errored']} errored; checking again in {BATCH_POLL_INTERVAL}s...")
+        time.sleep(BATCH_POLL_INTERVAL)
+
+
+def fetch_message_batch_results(client: httpx.Client, batch: dict) -> dict[int, list[str]]:
+    """Stream a finished batch's results JSONL and parse each reply."""
+    categories = {}
+    with client.stream("GET", batch["results_url"], headers=api_headers()) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
                 continue
-    
+            entry = json.loads(line)
+            result = entry["result"]
+            if result["type"] != "succeeded":
+                print(f"  {entry['custom_id']}: {result['type']}")
+                continue
+            cats = parse_message(result["message"])
+            for page_id, page_cats in cats.items():
+                print(f"  Page {page_id}: {', '.join(page_cats)}")
+            categories.update(cats)
     return categories
 
 
+def collect_message_batch(client: httpx.Client, batch_id: str) -> dict[int, list[str]]:
+    """Wait for a submitted batch to end and return its parsed results."""
+    batch = wait_for_message_batch(client, batch_id)
+    return fetch_message_batch_results(client, batch)
+
+
+def run_message_batch(pages: list[dict], batch_size: int,
+                      max_prompt_tokens: int) -> dict[int, list[str]]:
+    """Categorize via the Message Batches API, resuming an unfinished batch if any.
+
+    A stored batch is only trusted for pages whose content hash is unchanged
+    since it was submitted; every other page goes into a new batch.
+    """
+    categories = {}
+    with httpx.Client(timeout=60) as client:
+        pending = db.get_pending_categorize_batch()
+        if pending:
+            batch_id = pending["id"]
+            submitted = json.loads(pending["page_hashes"] or "{}")
+            resumable = {p['id'] for p in pages if submitted.get(str(p['id'])) == page_hash(p)}
+            if not resumable:
+                print(f"Message batch {batch_id} covers none of these pages; superseding it")
+                db.finish_categorize_batch(batch_id, "superseded")
+            else:
+                print(f"Resuming message batch {batch_id} for {len(resumable)} pages")
+                try:
+                    results = collect_message_batch(client, batch_id)
+                except httpx.HTTPStatusError as e:
+                    # Unknown to the API: deleted, expired, or another key/workspace
+                    print(f"Cannot resume message batch {batch_id} "
+                          f"({e.response.status_code}); submitting a new one")
+                    db.finish_categorize_batch(batch_id, "failed")
+                else:
+                    db.finish_categorize_batch(batch_id)
+                    categories = {pid: cats for pid, cats in results.items() if pid in resumable}
+
+        remaining = [p for p in pages if p['id'] not in categories]
+        if not remaining:
+            return categories
+        batches = make_batches(remaining, batch_size, max_prompt_tokens)
+        print(f"Processing {len(batches)} batches with the Message Batches API...")
+        batch_id = submit_message_batch(client, batches)
+        db.create_categorize_batch(
+            batch_id, json.dumps({str(p['id']): page_hash(p) for p in remaining})
+        )
+        print(f"Submitted message batch {batch_id}")
+        categories.update(collect_message_batch(client, batch_id))
+        db.finish_categorize_batch(batch_id)
+        return categories
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Categorize crawled pages with an LLM")
+    parser.add_argument("--mode", choices=["live", "batch"], default="live",
+                        help="live: concurrent Messages API calls; batch: Message Batches API, "
+                             "cheaper but can take hours (default: live)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help=f"Maximum pages per prompt (default: {BATCH_SIZE})")
+    parser.add_argument("--max-prompt-tokens", type=int, default=MAX_PROMPT_TOKENS,
+                        help=f"Approximate input token budget per prompt (default: {MAX_PROMPT_TOKENS})")
+    parser.add_argument("--tune", action="store_true",
+                        help="Live mode: time batch sizes %s on the first pages and keep the fastest"
+                             % "/".join(map(str, TUNE_BATCH_SIZES)))
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENCY,
+                        help=f"Maximum in-flight API requests (default: {MAX_CONCURRENCY})")
+    parser.add_argument("--rpm", type=int, default=REQUESTS_PER_MINUTE,
+                        help=f"Requests per minute limit (default: {REQUESTS_PER_MINUTE})")
+    parser.add_argument("--tpm", type=int, default=TOKENS_PER_MINUTE,
+                        help=f"Tokens per minute limit (default: {TOKENS_PER_MINUTE})")
+    args = parser.parse_args()
+
     if not API_KEY:
         print("Error: No ANTHROPIC_API_KEY found")
         print("Set it in environment or ~/.anthropic/api_key")
@@ -110,6 +518,8 @@ def main():
     print("=" * 60)
     print("PAGE CATEGORIZER")
     print("=" * 60)
+
+    db.init_db()
     
     conn = db.get_conn()
     pages = conn.execute("""
@@ -117,38 +527,40 @@ def main():
         FROM pages 
         ORDER BY id
     """).fetchall()
-    conn.close()
     
     print(f"Found {len(pages)} pages to categorize\n")
     
-    # Clear existing topics
-    conn = db.get_conn()
-    conn.execute("DELETE FROM page_topics")
-    conn.execute("DELETE FROM topics")
-    conn.commit()
-    conn.close()
-    
-    # Process in batches of 10
-    batch_size = 10
-    all_categories = {}
-    
-    for i in range(0, len(pages), batch_size):
-        batch = pages[i:i+batch_size]
-        print(f"Processing batch {i//batch_size + 1}/{(len(pages) + batch_size - 1)//batch_size}...")
-        
-        batch_dicts = [dict(p) for p in batch]
-        cats = categorize_batch(batch_dicts)
-        all_categories.update(cats)
-        
-        for page_id, page_cats in cats.items():
-            print(f"  Page {page_id}: {', '.join(page_cats)}")
+    # Pages whose title/description/domain were categorized before reuse that answer
+    all_categories, page_dicts = split_cached([dict(p) for p in pages])
+    print(f"{len(all_categories)} pages answered from cache, {len(page_dicts)} to send")
+
+    # Several pages per prompt; live mode keeps several requests in flight at once
+    if not page_dicts:
+        new_categories = {}
+    elif args.mode == "batch":
+        new_categories = run_message_batch(page_dicts, args.batch_size, args.max_prompt_tokens)
+    else:
+        new_categories = asyncio.run(run_live(
+            page_dicts, args.batch_size, args.max_prompt_tokens, args.tune,
+            args.concurrency, args.rpm, args.tpm,
+        ))
+    save_to_cache(page_dicts, new_categories)
+    all_categories.update(new_categories)
     
-    # Save to database
+    # Save to database, replacing existing topics in the same transaction so an
+    # interrupted run leaves the old topics in place. The model can echo back
+    # IDs that were not in the prompt; only link pages that exist.
     print("\nSaving to database...")
-    for page_id, cats in all_categories.items():
-        for cat in cats:
-            topic_id = db.get_or_create_topic(cat)
-            db.link_page_topic(page_id, topic_id)
+    page_ids = {p['id'] for p in pages}
+    pairs = [
+        (page_id, cat)
+        for page_id, cats in all_categories.items() if page_id in page_ids
+        for cat in cats
+    ]
+    with db.transaction() as conn:
+        conn.execute("DELETE FROM page_topics")
+        conn.execute("DELETE FROM topics")
+        db.link_pages_topics(pairs, conn)
     
     # Show results
     print("\n" + "=" * 60)
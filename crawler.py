@@ -1,11 +1,15 @@
 import argparse
+import asyncio
 import re
 import time
-from urllib.parse import urljoin, urlparse, urlunparse
+from collections import OrderedDict
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit
 from urllib.robotparser import RobotFileParser
 
-import requests
+import httpx
 from bs4 import BeautifulSoup
+from rbloom import Bloom
+from selectolax.lexbor import LexborHTMLParser
 
 import db
 
@@ -14,6 +18,15 @@ SKIP_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png", ".gif", ".svg", ".mp4", ".mp
                    ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx", ".zip", ".tar", ".gz")
 SKIP_PATH_PATTERNS = re.compile(r"/(login|signin|auth|logout|signup|register|account|sso)/", re.I)
 
+# Suffix tuples compiled to one anchored regex each, so filtering a link is a single search
+_ALLOWED_DOMAIN_RE = re.compile("(?:%s)$" % "|".join(map(re.escape, ALLOWED_TLDS)), re.I)
+_SKIP_EXT_RE = re.compile("(?:%s)$" % "|".join(map(re.escape, SKIP_EXTENSIONS)), re.I)
+_ALLOWED_SCHEMES = frozenset(("http", "https"))
+
+# Characters stripped from topic text: anything but word chars, whitespace and "-"
+_CLEAN_RE = re.compile(r"[^\w\s-]")
+_CLEAN_TRANS = str.maketrans({c: " " for c in map(chr, range(128)) if _CLEAN_RE.match(c)})
+
 STOP_WORDS = frozenset(
     "the a an of for to in on at by is it and or but with from as this that "
     "are was were be been being have has had do does did will would shall should "
@@ -30,63 +43,121 @@ STOP_WORDS = frozenset(
 USER_AGENT = "EduSpider/1.0 (educational crawler; +https://github.com/eduspider)"
 REQUEST_TIMEOUT = 15
 MIN_TOPIC_LENGTH = 3
-
-# Per-domain rate limiting
-_last_request_time = {}
-_robots_cache = {}
-
-
-def rate_limit(domain):
-    now = time.time()
-    last = _last_request_time.get(domain, 0)
-    wait = 1.0 - (now - last)
-    if wait > 0:
-        time.sleep(wait)
-    _last_request_time[domain] = time.time()
-
-
-def check_robots(url):
-    parsed = urlparse(url)
-    domain = parsed.netloc
-    if domain in _robots_cache:
-        return _robots_cache[domain].can_fetch(USER_AGENT, url)
-    robots_url = f"{parsed.scheme}://{domain}/robots.txt"
+WORKERS = 32
+MAX_PAGE_BYTES = 2_000_000  # bodies are truncated here; title/meta/headings/links come early
+DOMAIN_DELAY = 1.0  # minimum seconds between requests to one domain
+FETCH_RETRIES = 2
+RETRY_BACKOFF = 1.0  # seconds, doubled per attempt unless the server sends Retry-After
+MAX_RETRY_AFTER = 60  # a longer Retry-After gives up on the URL instead of stalling the domain
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+ROBOTS_TIMEOUT = 5
+ROBOTS_CACHE_SIZE = 10000
+
+# Visited-URL Bloom filter: sized for ~200 discovered links per page, capped at 10M URLs
+VISITED_LINKS_PER_PAGE = 200
+VISITED_MAX_ITEMS = 10_000_000
+VISITED_ERROR_RATE = 0.001
+
+# Shared HTTP client, created lazily so it binds to the running event loop
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        # Keep-alive pool shared by every worker; the transport retries failed connects
+        transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+            http2=True,
+            retries=FETCH_RETRIES,
+        )
+        _client = httpx.AsyncClient(
+            transport=transport,
+            headers={"User-Agent": USER_AGENT},
+            timeout=REQUEST_TIMEOUT,
+        )
+    return _client
+
+
+async def rate_limit(domain, domain_locks, last_request_time):
+    # The lock serializes requests to one domain; other domains proceed in parallel
+    lock = domain_locks.get(domain)
+    if lock is None:
+        lock = domain_locks[domain] = asyncio.Lock()
+    async with lock:
+        # Re-check after sleeping: a retry may have pushed the slot back meanwhile
+        while (wait := DOMAIN_DELAY - (time.time() - last_request_time.get(domain, 0))) > 0:
+            await asyncio.sleep(wait)
+        last_request_time[domain] = time.time()
+
+
+async def fetch_robots(robots_url):
     rp = RobotFileParser()
     rp.set_url(robots_url)
     try:
-        rp.read()
+        resp = await get_client().get(robots_url, timeout=ROBOTS_TIMEOUT, follow_redirects=True)
     except Exception:
-        pass  # If we can't read robots.txt, assume allowed
-    _robots_cache[domain] = rp
+        rp.allow_all = True  # If we can't read robots.txt, assume allowed
+        return rp
+    # 401/403 and 4xx as in RobotFileParser.read(); a 5xx robots.txt usually means
+    # an overloaded server, and RFC 9309 says to treat it as complete disallow
+    if resp.status_code in (401, 403) or resp.status_code >= 500:
+        rp.disallow_all = True
+    elif resp.status_code >= 400:
+        rp.allow_all = True
+    else:
+        rp.parse(resp.text.splitlines())
+    return rp
+
+
+async def check_robots(url, robots_cache):
+    """robots_cache is an OrderedDict of domain -> fetch task, in LRU order.
+
+    It belongs to one crawl: the tasks are tied to that crawl's event loop.
+    """
+    parsed = urlparse(url)
+    domain = parsed.netloc
+    # Cache the fetch task itself so concurrent workers share one request per domain
+    task = robots_cache.get(domain)
+    if task is None:
+        task = asyncio.ensure_future(fetch_robots(f"{parsed.scheme}://{domain}/robots.txt"))
+        robots_cache[domain] = task
+        if len(robots_cache) > ROBOTS_CACHE_SIZE:
+            robots_cache.popitem(last=False)
+    else:
+        robots_cache.move_to_end(domain)
+    rp = await task
     return rp.can_fetch(USER_AGENT, url)
 
 
 def normalize_url(url):
-    parsed = urlparse(url)
+    # urlsplit skips urlparse's ;params handling and is cheaper on this hot path
+    _, netloc, path, query, _ = urlsplit(url)
     # Normalize scheme to https
     scheme = "https"
     # Lowercase domain (keep www - some domains only work with it)
-    netloc = parsed.netloc.lower()
+    netloc = netloc.lower()
     # Remove fragment, normalize trailing slash on path
-    path = parsed.path.rstrip("/") or "/"
-    return urlunparse((scheme, netloc, path, parsed.params, parsed.query, ""))
+    path = path.rstrip("/") or "/"
+    return urlunsplit((scheme, netloc, path, query, ""))
 
 
 def is_allowed_domain(url):
-    domain = urlparse(url).netloc.lower()
-    return any(domain.endswith(tld) for tld in ALLOWED_TLDS)
+    return _ALLOWED_DOMAIN_RE.search(urlsplit(url).netloc) is not None
 
 
 def should_skip_url(url):
     parsed = urlparse(url)
-    if parsed.scheme not in ("http", "https"):
-        return True
-    lower_path = parsed.path.lower()
-    if any(lower_path.endswith(ext) for ext in SKIP_EXTENSIONS):
+    if parsed.scheme not in _ALLOWED_SCHEMES:
         return True
-    if SKIP_PATH_PATTERNS.search(parsed.path):
-        return True
-    return False
+    return bool(_SKIP_EXT_RE.search(parsed.path) or SKIP_PATH_PATTERNS.search(parsed.path))
+
+
+def _clean_text(text):
+    # Same result as _CLEAN_RE.sub(" ", text); translate() skips the regex engine for ASCII
+    if text.isascii():
+        return text.translate(_CLEAN_TRANS)
+    return _CLEAN_RE.sub(" ", text)
 
 
 def extract_topics(title, headings):
@@ -98,33 +169,104 @@ def extract_topics(title, headings):
     topics = set()
     for text in raw_texts:
         # Clean and split
-        text = re.sub(r"[^\w\s-]", " ", text.lower())
-        words = text.split()
+        words = [w.strip("-") for w in _clean_text(text.lower()).split()]
         # Single meaningful words
-        for word in words:
-            word = word.strip("-")
-            if len(word) >= MIN_TOPIC_LENGTH and word not in STOP_WORDS and not word.isdigit():
-                topics.add(word)
+        topics.update(
+            w for w in words
+            if len(w) >= MIN_TOPIC_LENGTH and w not in STOP_WORDS and not w.isdigit()
+        )
         # Bigrams from headings (captures short phrases)
-        for i in range(len(words) - 1):
-            a, b = words[i].strip("-"), words[i + 1].strip("-")
-            if a not in STOP_WORDS and b not in STOP_WORDS and len(a) >= MIN_TOPIC_LENGTH and len(b) >= MIN_TOPIC_LENGTH:
-                topics.add(f"{a} {b}")
+        topics.update(
+            f"{a} {b}" for a, b in zip(words, words[1:])
+            if a not in STOP_WORDS and b not in STOP_WORDS and len(a) >= MIN_TOPIC_LENGTH and len(b) >= MIN_TOPIC_LENGTH
+        )
 
     return topics
 
 
-def fetch_page(url):
-    headers = {"User-Agent": USER_AGENT}
-    resp = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT, allow_redirects=True)
+def _retry_delay(resp, attempt):
+    try:
+        return float(resp.headers["Retry-After"])
+    except (KeyError, ValueError):  # absent, or an HTTP date
+        return RETRY_BACKOFF * 2 ** attempt
+
+
+async def fetch_page(url, domain, domain_locks, last_request_time):
+    """Fetch a page's HTML, or None if it is not HTML.
+
+    Every attempt, retries included, goes through rate_limit(). A retryable
+    status pushes the whole domain's next slot back by the retry delay, so
+    other workers wait too.
+    """
+    client = get_client()
+    for attempt in range(FETCH_RETRIES + 1):
+        await rate_limit(domain, domain_locks, last_request_time)
+        async with client.stream("GET", url, follow_redirects=True) as resp:
+            if resp.status_code in RETRY_STATUSES:
+                delay = _retry_delay(resp, attempt)
+                last_request_time[domain] = max(
+                    last_request_time.get(domain, 0),
+                    time.time() + min(delay, MAX_RETRY_AFTER) - DOMAIN_DELAY,
+                )
+                if attempt < FETCH_RETRIES and delay <= MAX_RETRY_AFTER:
+                    continue
+            return await _read_html(resp)
+
+
+async def _read_html(resp):
     resp.raise_for_status()
     content_type = resp.headers.get("Content-Type", "")
     if "text/html" not in content_type:
-        return None
-    return resp.text
+        return None  # closed without downloading the body
+    data = bytearray()
+    async for chunk in resp.aiter_bytes():
+        data.extend(chunk)
+        if len(data) >= MAX_PAGE_BYTES:
+            break
+    return data[:MAX_PAGE_BYTES].decode(resp.encoding or "utf-8", "replace")
 
 
 def parse_page(html, base_url):
+    try:
+        return _parse_page_selectolax(html, base_url)
+    except Exception:
+        # Fall back to the slower but more forgiving parser on malformed pages
+        return _parse_page_bs4(html, base_url)
+
+
+def _parse_page_selectolax(html, base_url):
+    tree = LexborHTMLParser(html)
+
+    title = ""
+    title_tag = tree.css_first("title")
+    if title_tag:
+        title = title_tag.text(strip=True)
+
+    description = ""
+    meta_desc = tree.css_first('meta[name="description"]')
+    if meta_desc and meta_desc.attributes.get("content"):
+        description = meta_desc.attributes["content"].strip()
+    if not description:
+        first_p = tree.css_first("p")
+        if first_p:
+            description = first_p.text(strip=True)[:300]
+
+    headings = []
+    for tag in tree.css("h1, h2, h3"):
+        text = tag.text(strip=True)
+        if text:
+            headings.append(text)
+
+    links = set()
+    for a in tree.css("a[href]"):
+        href = a.attributes.get("href") or ""
+        full_url = urljoin(base_url, href)
+        links.add(full_url)
+
+    return title, description, headings, links
+
+
+def _parse_page_bs4(html, base_url):
     soup = BeautifulSoup(html, "html.parser")
 
     title = ""
@@ -155,67 +297,111 @@ def parse_page(html, base_url):
     return title, description, headings, links
 
 
-def crawl(url, max_depth, crawl_id, max_pages=200, depth=0, visited=None, pages_count=None):
-    if pages_count is None:
-        pages_count = [0]  # mutable counter shared across recursion
-    if visited is None:
-        visited = set()
-
-    url = normalize_url(url)
-
-    if url in visited or depth > max_depth or pages_count[0] >= max_pages:
-        return 0
-
-    visited.add(url)
-
-    if db.page_exists(url):
-        return 0
-
-    parsed = urlparse(url)
-    domain = parsed.netloc.lower()
-
-    if not check_robots(url):
-        print(f"  [blocked by robots.txt] {url}")
-        return 0
-
-    rate_limit(domain)
-
-    print(f"  [depth {depth}] Fetching: {url}")
+async def crawl(seed_url, max_depth, crawl_id, max_pages=200, workers=WORKERS):
+    """Breadth-first crawl from seed_url with a pool of async workers.
+
+    Returns the number of pages saved.
+    """
+    if workers < 1:
+        raise ValueError(f"workers must be at least 1, got {workers}")
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    # URLs already queued. A Bloom filter takes ~2 bytes per URL instead of
+    # ~100+ for a set entry; a false positive only skips an unseen link.
+    visited = Bloom(
+        max(1, min(max_pages * VISITED_LINKS_PER_PAGE, VISITED_MAX_ITEMS)), VISITED_ERROR_RATE
+    )
+    pages_found = 0
+    conn = db.get_conn()
+    # Per-domain rate limiting and robots.txt, scoped to this crawl: asyncio
+    # locks and tasks belong to the event loop they were created on
+    domain_locks = {}
+    last_request_time = {}
+    robots_cache = OrderedDict()
+
+    seed_url = normalize_url(seed_url)
+    visited.add(seed_url)
+    queue.put_nowait((seed_url, 0))
+
+    # Everything queued is already normalized
+    async def process(url, depth):
+        nonlocal pages_found
+        if depth > max_depth or pages_found >= max_pages:
+            return
+
+        if db.page_exists(url):
+            return
+
+        parsed = urlparse(url)
+        domain = parsed.netloc.lower()
+
+        if not await check_robots(url, robots_cache):
+            print(f"  [blocked by robots.txt] {url}")
+            return
+
+        print(f"  [depth {depth}] Fetching: {url}")
+        try:
+            html = await fetch_page(url, domain, domain_locks, last_request_time)
+        except Exception as e:
+            print(f"  [error] {url}: {e}")
+            return
+
+        if html is None:
+            return
+
+        # Parsing is CPU-bound; keep it off the event loop
+        title, description, headings, links = await loop.run_in_executor(
+            None, parse_page, html, url
+        )
+
+        # Other workers may have filled the quota while this page was in flight
+        if pages_found >= max_pages:
+            return
+
+        topics = extract_topics(title, headings)
+
+        # Page row, topics and links go in one transaction (one fsync per page)
+        with db.transaction(conn):
+            page_id = db.save_page(url, title, description, domain, depth, crawl_id, conn=conn)
+            if page_id is not None:
+                db.link_page_topics(page_id, topics, conn)
+        if page_id is None:
+            return  # Already saved by another path
+
+        pages_found += 1
+
+        if depth < max_depth and pages_found < max_pages:
+            # Normalize each link once; the set also drops duplicates on the page
+            for link in {normalize_url(l) for l in links}:
+                if link in visited:
+                    continue
+                if should_skip_url(link):
+                    continue
+                if not is_allowed_domain(link):
+                    continue
+                visited.add(link)
+                queue.put_nowait((link, depth + 1))
+
+    async def worker():
+        while True:
+            url, depth = await queue.get()
+            try:
+                await process(url, depth)
+            finally:
+                queue.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    join = asyncio.create_task(queue.join())
     try:
-        html = fetch_page(url)
-    except Exception as e:
-        print(f"  [error] {url}: {e}")
-        return 0
-
-    if html is None:
-        return 0
-
-    title, description, headings, links = parse_page(html, url)
-
-    page_id = db.save_page(url, title, description, domain, depth, crawl_id)
-    if page_id is None:
-        return 0  # Already saved by another path
-
-    pages_found = 1
-    pages_count[0] += 1
-
-    topics = extract_topics(title, headings)
-    for topic_name in topics:
-        topic_id = db.get_or_create_topic(topic_name)
-        db.link_page_topic(page_id, topic_id)
-
-    if depth < max_depth and pages_count[0] < max_pages:
-        for link in links:
-            if pages_count[0] >= max_pages:
-                break
-            link = normalize_url(link)
-            if link in visited:
-                continue
-            if should_skip_url(link):
-                continue
-            if not is_allowed_domain(link):
-                continue
-            pages_found += crawl(link, max_depth, crawl_id, max_pages, depth + 1, visited, pages_count)
+        done, _ = await asyncio.wait([join, *tasks], return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()  # re-raise a worker failure
+    finally:
+        join.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(join, *tasks, return_exceptions=True)
+        await get_client().aclose()
 
     return pages_found
 
@@ -225,7 +411,10 @@ def main():
     parser.add_argument("url", help="Seed URL to start crawling from")
     parser.add_argument("--depth", type=int, default=10, help="Maximum crawl depth (default: 10)")
     parser.add_argument("--max-pages", type=int, default=200, help="Maximum pages to crawl (default: 200)")
+    parser.add_argument("--workers", type=int, default=WORKERS, help=f"Concurrent fetch workers (default: {WORKERS})")
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
 
     seed_url = args.url
     if not seed_url.startswith(("http://", "https://")):
@@ -241,14 +430,13 @@ def main():
     crawl_id = db.create_crawl(seed_url, args.depth)
 
     try:
-        pages_found = crawl(seed_url, args.depth, crawl_id, args.max_pages)
+        pages_found = asyncio.run(crawl(seed_url, args.depth, crawl_id, args.max_pages, args.workers))
         db.finish_crawl(crawl_id, pages_found, "done")
         print(f"\nCrawl complete. Pages found: {pages_found}")
     except KeyboardInterrupt:
         print("\nCrawl interrupted by user.")
         conn = db.get_conn()
         row = conn.execute("SELECT COUNT(*) as c FROM pages WHERE crawl_id = ?", (crawl_id,)).fetchone()
-        conn.close()
         db.finish_crawl(crawl_id, row["c"], "interrupted")
         print(f"Saved {row['c']} pages before stopping.")
     except Exception as e:
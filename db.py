@@ -1,18 +1,68 @@
+import functools
 import sqlite3
 import os
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eduspider.db")
 
 
+_local = threading.local()
+
+# Bumped on every write made through this module. Reads are cached against it
+# plus PRAGMA data_version, which changes when another connection (e.g. a
+# crawl in a separate process) commits.
+_write_version = 0
+
+
 def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
+    """Return this thread's connection, opening it on first use.
+
+    Connections are kept for the life of the thread and run in autocommit
+    mode; callers that need a transaction issue BEGIN/COMMIT themselves.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA foreign_keys=ON;
+            PRAGMA mmap_size=268435456;
+            PRAGMA cache_size=-65536;
+            PRAGMA temp_store=MEMORY;
+        """)
+        _local.conn = conn
     return conn
 
 
+@contextmanager
+def transaction(conn=None):
+    """Run the enclosed statements in one BEGIN IMMEDIATE ... COMMIT."""
+    conn = conn or get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    _bump_write_version()
+
+
+def _bump_write_version():
+    global _write_version
+    _write_version += 1
+
+
+def _cache_version():
+    # data_version values are only comparable on one connection, hence the thread id
+    data_version = get_conn().execute("PRAGMA data_version").fetchone()[0]
+    return threading.get_ident(), data_version, _write_version
+
+
 def init_db():
     conn = get_conn()
     conn.executescript("""
@@ -39,7 +89,8 @@ def init_db():
         CREATE TABLE IF NOT EXISTS topics (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL UNIQUE,
-            created_at TEXT NOT NULL
+            created_at TEXT NOT NULL,
+            page_count INTEGER NOT NULL DEFAULT 0
         );
 
         CREATE TABLE IF NOT EXISTS page_topics (
@@ -48,12 +99,87 @@ def init_db():
             PRIMARY KEY (page_id, topic_id)
         );
 
+        CREATE TABLE IF NOT EXISTS categorize_batches (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'submitted',
+            page_hashes TEXT,
+            created_at TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS category_cache (
+            hash TEXT PRIMARY KEY,
+            response TEXT NOT NULL
+        );
+
         CREATE INDEX IF NOT EXISTS idx_pages_url ON pages(url);
         CREATE INDEX IF NOT EXISTS idx_pages_domain ON pages(domain);
         CREATE INDEX IF NOT EXISTS idx_topics_name ON topics(name);
+        CREATE INDEX IF NOT EXISTS idx_page_topics_topic_id ON page_topics(topic_id);
+    """)
+
+    # Databases created before topics.page_count existed: add and backfill it
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(topics)")}
+    if "page_count" not in columns:
+        with transaction(conn):
+            conn.execute("ALTER TABLE topics ADD COLUMN page_count INTEGER NOT NULL DEFAULT 0")
+            conn.execute("""
+                UPDATE topics SET page_count =
+                    (SELECT COUNT(*) FROM page_topics WHERE topic_id = topics.id)
+            """)
+
+    # Batches stored before page_hashes existed can't be matched to any pages,
+    # so they are superseded rather than resumed
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(categorize_batches)")}
+    if "page_hashes" not in columns:
+        conn.execute("ALTER TABLE categorize_batches ADD COLUMN page_hashes TEXT")
+
+    # Full-text index over page titles and descriptions, kept in sync by triggers.
+    # Existing pages are indexed once, when the table is first created.
+    fts_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pages_fts'"
+    ).fetchone()
+    conn.executescript("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(
+            title, description,
+            content='pages', content_rowid='id',
+            tokenize='porter unicode61'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS pages_fts_insert AFTER INSERT ON pages
+        BEGIN
+            INSERT INTO pages_fts (rowid, title, description)
+            VALUES (NEW.id, NEW.title, NEW.description);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS pages_fts_delete AFTER DELETE ON pages
+        BEGIN
+            INSERT INTO pages_fts (pages_fts, rowid, title, description)
+            VALUES ('delete', OLD.id, OLD.title, OLD.description);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS pages_fts_update AFTER UPDATE OF title, description ON pages
+        BEGIN
+            INSERT INTO pages_fts (pages_fts, rowid, title, description)
+            VALUES ('delete', OLD.id, OLD.title, OLD.description);
+            INSERT INTO pages_fts (rowid, title, description)
+            VALUES (NEW.id, NEW.title, NEW.description);
+        END;
+    """)
+    if not fts_exists:
+        conn.execute("INSERT INTO pages_fts (pages_fts) VALUES ('rebuild')")
+
+    # Keep topics.page_count in step with page_topics
+    conn.executescript("""
+        CREATE TRIGGER IF NOT EXISTS page_topics_count_insert AFTER INSERT ON page_topics
+        BEGIN
+            UPDATE topics SET page_count = page_count + 1 WHERE id = NEW.topic_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS page_topics_count_delete AFTER DELETE ON page_topics
+        BEGIN
+            UPDATE topics SET page_count = page_count - 1 WHERE id = OLD.topic_id;
+        END;
     """)
-    conn.commit()
-    conn.close()
 
 
 def create_crawl(seed_url, max_depth):
@@ -63,8 +189,6 @@ def create_crawl(seed_url, max_depth):
         (seed_url, max_depth, datetime.now().isoformat(), "running"),
     )
     crawl_id = cur.lastrowid
-    conn.commit()
-    conn.close()
     return crawl_id
 
 
@@ -74,77 +198,143 @@ def finish_crawl(crawl_id, pages_found, status="done"):
         "UPDATE crawls SET pages_found = ?, status = ? WHERE id = ?",
         (pages_found, status, crawl_id),
     )
-    conn.commit()
-    conn.close()
 
 
-def save_page(url, title, description, domain, crawl_depth, crawl_id):
+def create_categorize_batch(batch_id, page_hashes):
+    """Record a submitted batch with the JSON {page id: content hash} it covers."""
     conn = get_conn()
-    try:
-        cur = conn.execute(
-            """INSERT INTO pages (url, title, description, domain, crawl_depth, crawl_id, created_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (url, title, description, domain, crawl_depth, crawl_id, datetime.now().isoformat()),
-        )
-        page_id = cur.lastrowid
-        conn.commit()
-        conn.close()
-        return page_id
-    except sqlite3.IntegrityError:
-        conn.close()
-        return None
+    conn.execute(
+        "INSERT INTO categorize_batches (id, status, page_hashes, created_at) VALUES (?, ?, ?, ?)",
+        (batch_id, "submitted", page_hashes, datetime.now().isoformat()),
+    )
 
 
-def page_exists(url):
+def get_pending_categorize_batch():
+    """Return the newest unfinished batch row (id, page_hashes), or None."""
     conn = get_conn()
-    row = conn.execute("SELECT id FROM pages WHERE url = ?", (url,)).fetchone()
-    conn.close()
-    return row is not None
+    return conn.execute(
+        "SELECT id, page_hashes FROM categorize_batches WHERE status = 'submitted' "
+        "ORDER BY created_at DESC LIMIT 1"
+    ).fetchone()
 
 
-def get_or_create_topic(name):
+def finish_categorize_batch(batch_id, status="done"):
     conn = get_conn()
-    row = conn.execute("SELECT id FROM topics WHERE name = ?", (name,)).fetchone()
-    if row:
-        topic_id = row["id"]
-    else:
-        cur = conn.execute(
-            "INSERT INTO topics (name, created_at) VALUES (?, ?)",
-            (name, datetime.now().isoformat()),
-        )
-        topic_id = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return topic_id
+    conn.execute(
+        "UPDATE categorize_batches SET status = ? WHERE id = ?",
+        (status, batch_id),
+    )
 
 
-def link_page_topic(page_id, topic_id):
+def get_cached_categories(hashes):
+    """Map each cached hash in `hashes` to its stored response."""
+    hashes = list(hashes)
     conn = get_conn()
-    try:
-        conn.execute(
-            "INSERT INTO page_topics (page_id, topic_id) VALUES (?, ?)",
-            (page_id, topic_id),
+    cached = {}
+    # Stay well under SQLite's bound-parameter limit
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT hash, response FROM category_cache WHERE hash IN ({placeholders})", chunk
+        ).fetchall()
+        cached.update((row["hash"], row["response"]) for row in rows)
+    return cached
+
+
+def cache_categories(rows):
+    """Store (hash, response) pairs, replacing older answers."""
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO category_cache (hash, response) VALUES (?, ?)", rows
         )
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass
-    conn.close()
+
+
+def save_page(url, title, description, domain, crawl_depth, crawl_id, conn=None):
+    """Insert a page and return its id, or None if the URL is already stored."""
+    conn = conn or get_conn()
+    row = conn.execute(
+        """INSERT INTO pages (url, title, description, domain, crawl_depth, crawl_id, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT(url) DO NOTHING
+           RETURNING id""",
+        (url, title, description, domain, crawl_depth, crawl_id, datetime.now().isoformat()),
+    ).fetchone()
+    _bump_write_version()
+    return row["id"] if row else None
+
+
+def page_exists(url):
+    conn = get_conn()
+    row = conn.execute("SELECT 1 FROM pages WHERE url = ? LIMIT 1", (url,)).fetchone()
+    return row is not None
+
+
+def get_or_create_topics(names, conn=None):
+    """Upsert topics by name; returns a {name: id} dict for all `names`."""
+    conn = conn or get_conn()
+    names = list(set(names))
+    now = datetime.now().isoformat()
+    conn.executemany(
+        "INSERT OR IGNORE INTO topics (name, created_at) VALUES (?, ?)",
+        [(name, now) for name in names],
+    )
+    topic_ids = {}
+    # Stay well under SQLite's bound-parameter limit
+    for i in range(0, len(names), 500):
+        chunk = names[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT id, name FROM topics WHERE name IN ({placeholders})", chunk
+        ).fetchall()
+        topic_ids.update((row["name"], row["id"]) for row in rows)
+    return topic_ids
+
+
+def link_page_topics(page_id, topic_names, conn):
+    """Upsert topics and link them to a page with two executemany calls.
+
+    Does not commit; meant to run inside the caller's transaction.
+    """
+    link_pages_topics([(page_id, name) for name in topic_names], conn)
+
+
+def link_pages_topics(pairs, conn):
+    """Bulk link_page_topics for (page_id, topic_name) pairs across many pages.
+
+    Does not commit; meant to run inside the caller's transaction.
+    """
+    pairs = list(pairs)
+    topic_ids = get_or_create_topics({name for _, name in pairs}, conn)
+    conn.executemany(
+        "INSERT OR IGNORE INTO page_topics (page_id, topic_id) VALUES (?, ?)",
+        [(page_id, topic_ids[name]) for page_id, name in pairs],
+    )
+    _bump_write_version()
 
 
 def get_topics():
+    return _get_topics(_cache_version())
+
+
+@functools.lru_cache(maxsize=16)
+def _get_topics(version):
     conn = get_conn()
     rows = conn.execute("""
-        SELECT t.name, COUNT(pt.page_id) AS page_count
-        FROM topics t
-        JOIN page_topics pt ON t.id = pt.topic_id
-        GROUP BY t.id
+        SELECT name, page_count
+        FROM topics
+        WHERE page_count > 0
         ORDER BY page_count DESC
     """).fetchall()
-    conn.close()
     return rows
 
 
 def get_pages_for_topic(topic_name):
+    return _get_pages_for_topic(topic_name, _cache_version())
+
+
+@functools.lru_cache(maxsize=512)
+def _get_pages_for_topic(topic_name, version):
     conn = get_conn()
     rows = conn.execute("""
         SELECT p.url, p.title, p.description, p.domain
@@ -154,7 +344,24 @@ def get_pages_for_topic(topic_name):
         WHERE t.name = ?
         ORDER BY p.created_at DESC
     """, (topic_name,)).fetchall()
-    conn.close()
+    return rows
+
+
+def search_pages(query, limit=100):
+    """Full-text search over page titles and descriptions, best matches first."""
+    # Quote each word so user input is never parsed as FTS5 query syntax
+    terms = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+    if not terms:
+        return []
+    conn = get_conn()
+    rows = conn.execute("""
+        SELECT p.url, p.title, p.description, p.domain
+        FROM pages_fts f
+        JOIN pages p ON p.id = f.rowid
+        WHERE pages_fts MATCH ?
+        ORDER BY f.rank
+        LIMIT ?
+    """, (" ".join(terms), limit)).fetchall()
     return rows
 
 
@@ -163,5 +370,4 @@ def get_crawls():
     rows = conn.execute(
         "SELECT * FROM crawls ORDER BY started_at DESC"
     ).fetchall()
-    conn.close()
     return rows
@@ -1,4 +1,5 @@
-from flask import Flask, render_template
+from flask import Flask, render_template, request
+from waitress import serve
 import db
 
 app = Flask(__name__)
@@ -16,6 +17,13 @@ def topic(name):
     return render_template("topic.html", topic_name=name, pages=pages)
 
 
+@app.route("/search")
+def search():
+    query = request.args.get("q", "").strip()
+    pages = db.search_pages(query) if query else []
+    return render_template("search.html", query=query, pages=pages)
+
+
 @app.route("/crawls")
 def crawls():
     crawl_list = db.get_crawls()
@@ -24,4 +32,4 @@ def crawls():
 
 if __name__ == "__main__":
     db.init_db()
-    app.run(host="0.0.0.0", port=5555, debug=True)
+    serve(app, host="0.0.0.0", port=5555, threads=8)